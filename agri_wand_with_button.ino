@@ -49,6 +49,10 @@ WiFiManager wifiManager;
 String serverURL = "https://web-production-75c3a.up.railway.app/predict";
 // For local testing: "http://192.168.1.14:5000/predict"
 
+// Stream stage events (NDJSON) so the quick local verdict shows before Gemini answers
+const bool STREAM_RESULTS = true;
+const unsigned long STREAM_TIMEOUT = 60000;
+
 // Sensor data structure
 struct SensorData {
   float soilMoisture;
@@ -310,12 +314,20 @@ void captureAndAnalyze() {
   if (WiFi.status() == WL_CONNECTED) {
     HTTPClient http;
     http.begin(serverURL);
+    const char* responseHeaders[] = {"Retry-After"};
+    http.collectHeaders(responseHeaders, 1);
     
     // Add sensor data as custom headers
     http.addHeader("Content-Type", "image/jpeg");
     http.addHeader("X-Soil-Moisture", String(sensors.soilMoisture, 1));
     http.addHeader("X-Temperature", String(sensors.temperature, 1));
     http.addHeader("X-Humidity", String(sensors.humidity, 1));
+    http.addHeader("X-Device-Id", WiFi.macAddress());
+    if (STREAM_RESULTS) {
+      // HTTP/1.0 disables chunked framing, so the body is plain NDJSON lines
+      http.useHTTP10(true);
+      http.addHeader("Accept", "application/x-ndjson");
+    }
     
     Serial.printf("📤 Sending to server: %s\n", serverURL.c_str());
     Serial.printf("   Soil: %.1f%%, Temp: %.1f°C, Humidity: %.1f%%\n",
@@ -323,9 +335,17 @@ void captureAndAnalyze() {
     
     int httpResponseCode = http.POST(fb->buf, fb->len);
     
+    bool gotResult = false;
     if (httpResponseCode == 200) {
-      String response = http.getString();
-      parseAIResponse(response);
+      if (STREAM_RESULTS) {
+        gotResult = readResultStream(http);
+      } else {
+        String response = http.getString();
+        gotResult = parseAIResponse(response);
+      }
+    }
+    
+    if (gotResult) {
       newAIResult = true;
       
       // Success beep
@@ -334,6 +354,17 @@ void captureAndAnalyze() {
       tone(BUZZER_PIN, 2000, 200);
       
       Serial.println("✅ Analysis complete!");
+    } else if (httpResponseCode == 200) {
+      newAIResult = false;  // Don't keep showing the previous scan as if it were this one
+      Serial.println("❌ No final result received");
+      tft.setTextColor(TFT_RED);
+      tft.println("\n✗ Incomplete result!");
+      tone(BUZZER_PIN, 500, 500);
+    } else if (httpResponseCode == 429) {
+      Serial.printf("⏳ Rate limited, retry after %s s\n", http.header("Retry-After").c_str());
+      tft.setTextColor(TFT_YELLOW);
+      tft.println("\n⏳ Too many scans, wait...");
+      tone(BUZZER_PIN, 800, 300);
     } else {
       Serial.printf("❌ HTTP Error: %d\n", httpResponseCode);
       tft.setTextColor(TFT_RED);
@@ -353,15 +384,67 @@ void captureAndAnalyze() {
   analysisInProgress = false;
 }
 
-void parseAIResponse(String response) {
+// Returns true only when the server's final event arrived
+bool readResultStream(HTTPClient& http) {
+  WiFiClient* stream = http.getStreamPtr();
+  unsigned long started = millis();
+  
+  while ((http.connected() || stream->available()) && millis() - started < STREAM_TIMEOUT) {
+    if (!stream->available()) {
+      delay(10);
+      continue;
+    }
+    
+    String line = stream->readStringUntil('\n');
+    line.trim();
+    if (!line.startsWith("{")) continue;
+    
+    DynamicJsonDocument doc(4096);
+    DeserializationError error = deserializeJson(doc, line);
+    if (error) {
+      Serial.printf("Stream JSON parse failed: %s\n", error.c_str());
+      continue;
+    }
+    
+    String event = doc["event"] | "";
+    Serial.printf("📶 Stage: %s\n", event.c_str());
+    
+    if (event == "local_result") {
+      // Preview only: aiResult is updated from the final event
+      const char* quickDisease = doc["result"]["disease"] | "Unknown";
+      tft.setTextColor(TFT_CYAN);
+      tft.printf("\nQuick: %s\n", quickDisease);
+      tft.println("Refining with Gemini...");
+    } else if (event == "final") {
+      applyAIResult(doc["result"].as<JsonObject>());
+      return true;
+    } else if (event == "error") {
+      Serial.printf("❌ Analysis error: %s\n", (const char*)(doc["error"] | "unknown"));
+      return false;
+    } else {
+      tft.setTextColor(TFT_YELLOW);
+      tft.printf("  %s\n", event.c_str());
+    }
+  }
+  
+  Serial.println("⚠ Result stream ended before final result");
+  return false;
+}
+
+bool parseAIResponse(String response) {
   DynamicJsonDocument doc(4096);  // Increased size for sensor recommendations
   DeserializationError error = deserializeJson(doc, response);
   
   if (error) {
     Serial.printf("JSON parse failed: %s\n", error.c_str());
-    return;
+    return false;
   }
   
+  applyAIResult(doc.as<JsonObject>());
+  return true;
+}
+
+void applyAIResult(JsonObject doc) {
   aiResult.disease = doc["disease"] | "Unknown";
   aiResult.confidence = doc["confidence"] | 0.0;
   aiResult.treatment = doc["treatment"] | "No treatment available";
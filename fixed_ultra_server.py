@@ -4,16 +4,23 @@ Fixed Ultra-Accurate Global Agricultural AI Wand
 Enhanced tomato mold detection + ALL plant support
 """
 
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import numpy as np
-from PIL import Image, ImageEnhance, ImageOps, ImageFilter
+from PIL import Image, ImageEnhance, ImageOps
 import io
 import os
 import logging
 from datetime import datetime
-import socket
+import gzip
+import hashlib
+import copy
 import json
+import math
+import threading
+import time
+from collections import OrderedDict, deque
 import dotenv
 
 # Load environment variables for local development
@@ -31,6 +38,18 @@ try:
 except ImportError:
     GEMINI_AVAILABLE = False
 
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
 app = Flask(__name__)
 CORS(app)
 
@@ -39,9 +58,34 @@ logger = logging.getLogger(__name__)
 
 # Configuration
 IMAGE_SIZE = (256, 256)
+# Uploads are decoded/reduced to at most this side before enhancement (see AnalysisWorkspace)
+PREPROCESS_MAX_SIDE = int(os.getenv('PREPROCESS_MAX_SIDE', 1024))
 CONFIDENCE_THRESHOLD = 0.75
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY', '')
 
+# Per-device admission control (limits apply per gunicorn worker)
+# Reverse proxies in front of the app whose X-Forwarded-For hops are trusted. 0 when serving
+# directly; the Procfile/nixpacks deployment sets 1 for the Railway edge proxy
+TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', 0))
+DEVICE_RATE_PER_MINUTE = float(os.getenv('DEVICE_RATE_PER_MINUTE', 12))
+DEVICE_BURST = int(os.getenv('DEVICE_BURST', 4))
+DEVICE_MAX_QUEUED = int(os.getenv('DEVICE_MAX_QUEUED', 2))
+PREDICT_CONCURRENCY = int(os.getenv('PREDICT_CONCURRENCY', 2))
+PREDICT_QUEUE_TIMEOUT = float(os.getenv('PREDICT_QUEUE_TIMEOUT', 30))
+
+# Single-flight coalescing of identical concurrent analyses
+COALESCE_SENSOR_BUCKET = float(os.getenv('COALESCE_SENSOR_BUCKET', 1.0))
+COALESCE_DIR = os.getenv('COALESCE_DIR', '')  # set to share in-flight results across workers
+COALESCE_RESULT_TTL = float(os.getenv('COALESCE_RESULT_TTL', 15))
+
+# Fallback detector cascade: 'adaptive' (cost per hit) or a comma-separated fixed order
+CASCADE_ORDER = os.getenv('CASCADE_ORDER', 'adaptive')
+
+# Lesion-ring (early blight) search limits per image
+RING_PYRAMID_LEVELS = int(os.getenv('RING_PYRAMID_LEVELS', 3))
+RING_MAX_REGIONS = int(os.getenv('RING_MAX_REGIONS', 8))
+RING_MAX_HOUGH_CALLS = int(os.getenv('RING_MAX_HOUGH_CALLS', 16))
+
 UPLOAD_FOLDER = 'uploads'
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
@@ -105,62 +149,370 @@ DISEASE_PATTERNS = {
     }
 }
 
+# Fallback CV detectors, their result metadata and cheap preconditions on shared features.
+# prior_ms / prior_hit_rate seed the adaptive order until real stats accumulate.
+FALLBACK_DETECTORS = {
+    'tomato_leaf_mold': {
+        'method': 'detect_tomato_leaf_mold',
+        # Only the yellow-surface term (0.4) can lift mold confidence above 0.7
+        'precondition': lambda f: f['yellow_upper_ratio'] > 0.12,
+        'plant_type': 'Tomato',
+        'treatment': 'Increase ventilation, reduce humidity, apply copper-based fungicide',
+        'prevention': 'Ensure good air circulation, water at base of plants',
+        'severity': 'Moderate to Severe',
+        'prior_ms': 2.0,
+        'prior_hit_rate': 0.3
+    },
+    'tomato_early_blight': {
+        'method': 'detect_early_blight',
+        'precondition': lambda f: f['brown_ratio'] > 0,
+        'plant_type': 'Tomato',
+        'treatment': 'Remove affected leaves, apply fungicide',
+        'prevention': 'Crop rotation, proper spacing',
+        'severity': 'Moderate',
+        'prior_ms': 15.0,
+        'prior_hit_rate': 0.3
+    },
+    'powdery_mildew': {
+        'method': 'detect_powdery_mildew',
+        'precondition': lambda f: f['white_ratio'] > 0.15,
+        'plant_type': 'Unknown',
+        'treatment': 'Apply sulfur fungicide, improve ventilation',
+        'prevention': 'Proper spacing, resistant varieties',
+        'severity': 'Moderate',
+        'prior_ms': 3.0,
+        'prior_hit_rate': 0.05
+    }
+}
+
+class DetectorCascade:
+    """
+    Early-exit scheduler for the fallback detectors. Detectors whose precondition
+    fails on the shared features are skipped; the rest run in ascending order of
+    expected cost per hit (run rate * mean latency / hit rate), learned at runtime.
+    
+    Execution order only affects cost, never the verdict: preconditions can overlap
+    (white pixels are also gray-powder pixels), so when several detectors hit, the
+    one with the highest priority wins. Priority is the configured order. After a
+    hit, only detectors that outrank it still need to run.
+    """
+    PRIOR_WEIGHT = 10
+    LATENCY_SMOOTHING = 0.1
+    
+    def __init__(self, order='adaptive'):
+        self.lock = threading.Lock()
+        self.adaptive = order.strip().lower() == 'adaptive'
+        if self.adaptive:
+            self.fixed_order = list(FALLBACK_DETECTORS)
+        else:
+            names = [name.strip() for name in order.split(',') if name.strip()]
+            unknown = [name for name in names if name not in FALLBACK_DETECTORS]
+            self.fixed_order = list(dict.fromkeys(name for name in names if name in FALLBACK_DETECTORS))
+            if unknown:
+                logger.warning(f"CASCADE_ORDER ignores unknown detectors: {', '.join(unknown)}")
+            if not self.fixed_order:
+                logger.warning(f"CASCADE_ORDER '{order}' names no known detectors, using default order")
+                self.fixed_order = list(FALLBACK_DETECTORS)
+            disabled = [name for name in FALLBACK_DETECTORS if name not in self.fixed_order]
+            if disabled:
+                logger.warning(f"CASCADE_ORDER disables detectors: {', '.join(disabled)}")
+        self.priority = {name: rank for rank, name in enumerate(self.fixed_order)}
+        self.stats = {
+            name: {'evaluations': 0, 'runs': 0, 'hits': 0, 'skips': 0, 'mean_ms': spec['prior_ms']}
+            for name, spec in FALLBACK_DETECTORS.items()
+        }
+    
+    def expected_cost_per_hit(self, name):
+        stats = self.stats[name]
+        prior = FALLBACK_DETECTORS[name]
+        run_rate = (stats['runs'] + self.PRIOR_WEIGHT) / (stats['evaluations'] + self.PRIOR_WEIGHT)
+        hit_rate = (stats['hits'] + prior['prior_hit_rate'] * self.PRIOR_WEIGHT) / (stats['evaluations'] + self.PRIOR_WEIGHT)
+        return run_rate * stats['mean_ms'] / max(hit_rate, 1e-3)
+    
+    def current_order(self):
+        if not self.adaptive:
+            return list(self.fixed_order)
+        with self.lock:
+            return sorted(self.fixed_order, key=self.expected_cost_per_hit)
+    
+    def run(self, analyzer, img_array, threshold=0.7):
+        """Returns (detector_name, disease, confidence) for the highest-priority hit, or (None, None, 0.0)"""
+        features = analyzer.extract_shared_features(img_array)
+        order = self.current_order()
+        decisions = []
+        best = None
+        
+        for name in order:
+            if best and self.priority[name] > self.priority[best[0]]:
+                decisions.append(f"{name}:outranked")
+                continue
+            
+            spec = FALLBACK_DETECTORS[name]
+            if not spec['precondition'](features):
+                with self.lock:
+                    self.stats[name]['evaluations'] += 1
+                    self.stats[name]['skips'] += 1
+                decisions.append(f"{name}:skipped")
+                continue
+            
+            start = time.perf_counter()
+            disease, confidence = getattr(analyzer, spec['method'])(img_array, features)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            hit = bool(disease) and confidence > threshold
+            
+            with self.lock:
+                stats = self.stats[name]
+                stats['evaluations'] += 1
+                stats['runs'] += 1
+                stats['hits'] += int(hit)
+                stats['mean_ms'] += self.LATENCY_SMOOTHING * (elapsed_ms - stats['mean_ms'])
+            decisions.append(f"{name}:{'hit' if hit else 'miss'}({elapsed_ms:.1f}ms)")
+            
+            if hit:
+                best = (name, disease, confidence)
+        
+        logger.info(f"Cascade: {' -> '.join(decisions)}")
+        return best or (None, None, 0.0)
+    
+    def snapshot(self):
+        order = self.current_order()
+        with self.lock:
+            return {
+                'mode': 'adaptive' if self.adaptive else 'fixed',
+                'order': order,
+                'detectors': {
+                    name: dict(
+                        stats,
+                        mean_ms=round(stats['mean_ms'], 2),
+                        expected_cost_per_hit=round(self.expected_cost_per_hit(name), 2)
+                    )
+                    for name, stats in self.stats.items()
+                }
+            }
+
+class LesionRingDetector:
+    """
+    Multi-scale search for the concentric lesion rings of early blight.
+    Builds a blurred grayscale pyramid, restricts HoughCircles to the brown
+    candidate regions and searches one narrow radius band per pyramid level,
+    so large rings are found cheaply on coarse levels. Work per image is capped
+    by pyramid levels, region count and Hough calls only, so the verdict never
+    depends on server load; search_ms is reported for tuning those caps.
+    """
+    # Radius band searched at every level, in that level's pixels (level L covers 2**L times larger rings)
+    RADIUS_BAND = (4, 10)
+    MIN_REGION_AREA = 12
+    CLOSE_KERNEL = np.ones((5, 5), np.uint8)
+    
+    def __init__(self, levels=3, max_regions=8, max_hough_calls=16):
+        self.levels = max(1, levels)
+        self.max_regions = max_regions
+        self.max_hough_calls = max_hough_calls
+    
+    def candidate_regions(self, brown_mask):
+        """Bounding boxes (x, y, w, h) of brown blobs, largest first"""
+        # A bool mask is already 0/1 bytes; view it as uint8 instead of copying
+        mask = cv2.morphologyEx(brown_mask.view(np.uint8), cv2.MORPH_CLOSE, self.CLOSE_KERNEL)
+        count, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        regions = [tuple(stats[i, :4]) for i in range(1, count) if stats[i, cv2.CC_STAT_AREA] >= self.MIN_REGION_AREA]
+        regions.sort(key=lambda box: box[2] * box[3], reverse=True)
+        return regions[:self.max_regions]
+    
+    def detect(self, gray, brown_mask, blurred=None):
+        """
+        Returns ring features: ring_count plus how much work the search did.
+        `blurred` is an optional preallocated buffer for the pyramid base.
+        """
+        features = {'ring_count': 0, 'regions_examined': 0, 'hough_calls': 0, 'budget_exhausted': False, 'search_ms': 0.0}
+        regions = self.candidate_regions(brown_mask)
+        if not regions:
+            return features
+        
+        start = time.perf_counter()
+        pyramid = [cv2.GaussianBlur(gray, (5, 5), 1.5, dst=blurred)]
+        for _ in range(1, self.levels):
+            if min(pyramid[-1].shape) < 4 * self.RADIUS_BAND[1]:
+                break
+            pyramid.append(cv2.pyrDown(pyramid[-1]))
+        
+        min_radius, max_radius = self.RADIUS_BAND
+        rings = []
+        for x, y, w, h in regions:
+            features['regions_examined'] += 1
+            for level, image in enumerate(pyramid):
+                if features['hough_calls'] >= self.max_hough_calls:
+                    features['budget_exhausted'] = True
+                    break
+                
+                scale = 2 ** level
+                # Region in level coordinates, padded so rings centred near its edge still fit
+                x0 = max(0, x // scale - max_radius)
+                y0 = max(0, y // scale - max_radius)
+                x1 = min(image.shape[1], (x + w) // scale + max_radius)
+                y1 = min(image.shape[0], (y + h) // scale + max_radius)
+                if min(x1 - x0, y1 - y0) < 2 * min_radius + 1:
+                    continue
+                
+                features['hough_calls'] += 1
+                circles = cv2.HoughCircles(
+                    image[y0:y1, x0:x1], cv2.HOUGH_GRADIENT, dp=1, minDist=2 * min_radius,
+                    param1=50, param2=20, minRadius=min_radius, maxRadius=max_radius
+                )
+                if circles is not None:
+                    for cx, cy, r in circles[0]:
+                        rings.append(((cx + x0) * scale, (cy + y0) * scale, r * scale))
+            
+            if features['budget_exhausted']:
+                break
+        
+        # The same ring can be found from overlapping regions or adjacent levels
+        distinct = []
+        for cx, cy, r in rings:
+            if all(abs(cx - dx) > min_radius or abs(cy - dy) > min_radius or abs(r - dr) > r / 2
+                   for dx, dy, dr in distinct):
+                distinct.append((cx, cy, r))
+        features['ring_count'] = len(distinct)
+        features['search_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        return features
+
+# Per-channel threshold rules (channel, comparison, value), ANDed into a mask
+COLOR_RULES = {
+    'yellow_upper': ((0, np.greater, 150), (1, np.greater, 150), (2, np.less, 100)),
+    'gray_powder': ((0, np.greater, 180), (1, np.greater, 180), (2, np.greater, 180)),
+    'white': ((0, np.greater, 200), (1, np.greater, 200), (2, np.greater, 200)),
+    'brown': ((0, np.greater, 100), (1, np.less, 100), (2, np.less, 80))
+}
+
+class AnalysisWorkspace:
+    """
+    Preallocated buffers for analysing one IMAGE_SIZE frame, reused across requests.
+    
+    Memory budget per request (256x256 frame, PREPROCESS_MAX_SIDE=1024):
+    - decoding: JPEG draft mode plus ceiling integer reduction keep the enhanced
+      image at most 1024px per side (~3 MB RGB); the enhancement chain holds ~2
+      such images. Measured peak RSS growth for a 12 MP JPEG is ~21 MB per request
+      (67 MB idle worker -> 88 MB). Non-JPEG uploads have no draft mode and are
+      decoded at full size before the reduction (~77 MB for a 12 MP PNG).
+    - workspace: rgb 192 KB + gray/blurred/edges 64 KB each + two masks 64 KB each
+      ~= 0.5 MB, allocated once per worker thread
+    - detectors: masks, gray, blur and Canny output are written into the workspace
+      with out=/dst=; channel access is through views, so the steady state allocates
+      only small pyramid levels and Hough crops
+    """
+    def __init__(self, shape=(IMAGE_SIZE[1], IMAGE_SIZE[0]), rgb=None):
+        height, width = shape
+        self.rgb = rgb if rgb is not None else np.empty((height, width, 3), np.uint8)
+        self.gray = np.empty((height, width), np.uint8)
+        self.blurred = np.empty((height, width), np.uint8)
+        self.edges = np.empty((height, width), np.uint8)
+        self.mask = np.empty((height, width), bool)
+        self.scratch = np.empty((height, width), bool)
+        self.reset()
+    
+    def reset(self):
+        """Forget per-image caches (gray plane, current mask, color ratios)"""
+        self.gray_ready = False
+        self.mask_rule = None
+        self.ratios = {}
+    
+    def load(self, image):
+        """Copy a PIL image of the workspace size into the rgb buffer"""
+        np.copyto(self.rgb, np.asarray(image))
+        self.reset()
+        return self.rgb
+    
+    def grayscale(self):
+        if not self.gray_ready:
+            cv2.cvtColor(self.rgb, cv2.COLOR_RGB2GRAY, dst=self.gray)
+            self.gray_ready = True
+        return self.gray
+    
+    def color_mask(self, rule, out=None):
+        """Evaluate a COLOR_RULES entry in place (into self.mask by default)"""
+        if out is None:
+            if self.mask_rule == rule:
+                return self.mask
+            out = self.mask
+            self.mask_rule = rule
+        for i, (channel, compare, value) in enumerate(COLOR_RULES[rule]):
+            compare(self.rgb[:, :, channel], value, out=out if i == 0 else self.scratch)
+            if i > 0:
+                np.logical_and(out, self.scratch, out=out)
+        return out
+    
+    def color_ratio(self, rule):
+        """Fraction of channel values covered by a rule's mask, computed once per image"""
+        if rule not in self.ratios:
+            # Ratios stay relative to all channel values, as the detectors always used
+            self.ratios[rule] = np.count_nonzero(self.color_mask(rule)) / self.rgb.size
+        return self.ratios[rule]
+
 class FixedUltraPlantAnalyzer:
     def __init__(self):
         self.gemini_available = GEMINI_AVAILABLE and gemini_client is not None
         self.cv2_available = CV2_AVAILABLE
+        self.cascade = DetectorCascade(CASCADE_ORDER)
+        self.ring_detector = LesionRingDetector(RING_PYRAMID_LEVELS, RING_MAX_REGIONS, RING_MAX_HOUGH_CALLS)
+        self.local = threading.local()
+    
+    def workspace(self, img_array=None):
+        """This thread's reusable workspace, or a temporary one wrapping a foreign array"""
+        if getattr(self.local, 'workspace', None) is None:
+            self.local.workspace = AnalysisWorkspace()
+        if img_array is None or img_array is self.local.workspace.rgb:
+            return self.local.workspace
+        return AnalysisWorkspace(img_array.shape[:2], rgb=img_array)
     
     def advanced_preprocessing(self, image_bytes):
-        """Enhanced preprocessing for better disease detection"""
+        """Enhanced preprocessing for better disease detection, into this thread's workspace"""
         image = Image.open(io.BytesIO(image_bytes))
-        original = image.copy()
+        
+        # Let the JPEG decoder downscale (DCT scaling) and box-reduce anything still
+        # oversized, so full-resolution frames are never materialized
+        image.draft('RGB', (PREPROCESS_MAX_SIDE, PREPROCESS_MAX_SIDE))
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')  # reduce() rejects palette, 1-bit and 32-bit modes
+        factor = -(-max(image.size) // PREPROCESS_MAX_SIDE)  # ceiling, so the result fits the cap
+        if factor > 1:
+            image = image.reduce(factor)
         
         if image.mode != 'RGB':
             image = image.convert('RGB')
         
-        # Multiple preprocessing stages
-        processed_images = {}
-        
-        # Stage 1: Enhanced for disease detection
-        img1 = ImageOps.autocontrast(image)
-        img1 = ImageEnhance.Sharpness(img1).enhance(1.5)
-        img1 = ImageEnhance.Contrast(img1).enhance(1.4)
-        img1 = ImageEnhance.Color(img1).enhance(1.3)
-        processed_images['enhanced'] = img1.resize(IMAGE_SIZE, Image.LANCZOS)
+        # Enhanced for disease detection
+        image = ImageOps.autocontrast(image)
+        image = ImageEnhance.Sharpness(image).enhance(1.5)
+        image = ImageEnhance.Contrast(image).enhance(1.4)
+        image = ImageEnhance.Color(image).enhance(1.3)
         
-        # Stage 2: Color-focused for mold detection
-        img2 = ImageEnhance.Color(image).enhance(1.5)
-        img2 = ImageEnhance.Sharpness(img2).enhance(1.3)
-        processed_images['color_enhanced'] = img2.resize(IMAGE_SIZE, Image.LANCZOS)
-        
-        # Stage 3: Texture-focused for spot detection
-        img3 = image.filter(ImageFilter.DETAIL)
-        img3 = ImageEnhance.Contrast(img3).enhance(1.5)
-        processed_images['texture_enhanced'] = img3.resize(IMAGE_SIZE, Image.LANCZOS)
-        
-        return processed_images, original
+        return self.workspace().load(image.resize(IMAGE_SIZE, Image.LANCZOS))
+    
+    def extract_shared_features(self, img_array):
+        """Cheap color features shared by the cascade preconditions"""
+        workspace = self.workspace(img_array)
+        return {
+            'yellow_upper_ratio': workspace.color_ratio('yellow_upper'),
+            'white_ratio': workspace.color_ratio('white'),
+            'brown_ratio': workspace.color_ratio('brown')
+        }
     
-    def detect_tomato_leaf_mold(self, img_array):
-        """Specialized tomato leaf mold detection"""
+    def detect_tomato_leaf_mold(self, img_array, features=None):
+        """Specialized tomato leaf mold detection; `features` reuses extract_shared_features output"""
         if not self.cv2_available:
             return None, 0.0
         
         try:
-            # Convert to different color spaces
-            hsv = cv2.cvtColor(img_array, cv2.COLOR_RGB2HSV)
-            lab = cv2.cvtColor(img_array, cv2.COLOR_RGB2LAB)
+            workspace = self.workspace(img_array)
             
             # Yellow upper surface detection
-            yellow_upper_mask = (img_array[:, :, 0] > 150) & (img_array[:, :, 1] > 150) & (img_array[:, :, 2] < 100)
-            yellow_upper_ratio = np.sum(yellow_upper_mask) / img_array.size
+            yellow_upper_ratio = features['yellow_upper_ratio'] if features else workspace.color_ratio('yellow_upper')
             
             # Gray/white powder underneath detection
-            gray_powder_mask = (img_array[:, :, 0] > 180) & (img_array[:, :, 1] > 180) & (img_array[:, :, 2] > 180)
-            gray_powder_ratio = np.sum(gray_powder_mask) / img_array.size
+            gray_powder_ratio = workspace.color_ratio('gray_powder')
             
             # Texture analysis for powdery surface
-            gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
-            texture_var = np.var(gray)
+            _, stddev = cv2.meanStdDev(workspace.grayscale())
+            texture_var = float(stddev[0, 0]) ** 2
             
             # Enhanced detection logic
             mold_confidence = 0.0
@@ -183,54 +535,60 @@ class FixedUltraPlantAnalyzer:
             logger.error(f"Tomato mold detection failed: {e}")
             return None, 0.0
     
-    def detect_early_blight(self, img_array):
-        """Detect early blight concentric rings"""
+    def extract_early_blight_features(self, img_array):
+        """Lesion-ring and brown-area features for the early blight scorer"""
+        workspace = self.workspace(img_array)
+        brown_ratio = workspace.color_ratio('brown')
+        features = self.ring_detector.detect(workspace.grayscale(), workspace.color_mask('brown'), blurred=workspace.blurred)
+        features['brown_ratio'] = brown_ratio
+        return features
+    
+    def score_early_blight(self, features):
+        """Combine ring evidence with brown coverage into an early blight confidence"""
+        # The verdict is decided on integer ring counts, then mapped to a fixed
+        # confidence, so float rounding never decides the cascade's > 0.7 test:
+        # 4+ rings is a detection, 3 rings only when brown lesions corroborate
+        rings = features['ring_count']
+        corroborated = features['brown_ratio'] > 0.05
+        if rings >= 4:
+            confidence = 0.9 if corroborated else 0.8
+        elif rings == 3 and corroborated:
+            confidence = 0.75
+        elif features['brown_ratio'] > 0.15:
+            # Fallback to color analysis (reported, but below the detection threshold)
+            confidence = 0.7
+        elif rings > 0:
+            confidence = round(0.2 * rings, 2)
+        else:
+            return None, 0.0
+        return 'Tomato - Early Blight', confidence
+    
+    def detect_early_blight(self, img_array, features=None):
+        """Detect early blight concentric rings (brown ratio is cached per image in the workspace)"""
         if not self.cv2_available:
             return None, 0.0
         
         try:
-            gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
-            
-            # Look for circular patterns (concentric rings)
-            circles = cv2.HoughCircles(
-                gray, cv2.HOUGH_GRADIENT, dp=1, minDist=30,
-                param1=50, param2=30, minRadius=5, maxRadius=25
-            )
-            
-            if circles is not None:
-                circles = np.round(circles[0, :]).astype("int")
-                if len(circles) > 3:  # Multiple concentric circles
-                    return 'Tomato - Early Blight', 0.8
-            
-            # Fallback to color analysis
-            brown_mask = (img_array[:, :, 0] > 100) & (img_array[:, :, 1] < 100) & (img_array[:, :, 2] < 80)
-            brown_ratio = np.sum(brown_mask) / img_array.size
-            
-            if brown_ratio > 0.15:
-                return 'Tomato - Early Blight', 0.7
-            
-            return None, 0.0
-            
+            return self.score_early_blight(self.extract_early_blight_features(img_array))
+        
         except Exception as e:
             logger.error(f"Early blight detection failed: {e}")
             return None, 0.0
     
-    def detect_powdery_mildew(self, img_array):
-        """Detect powdery mildew across plants"""
+    def detect_powdery_mildew(self, img_array, features=None):
+        """Detect powdery mildew across plants; `features` reuses extract_shared_features output"""
         if not self.cv2_available:
             return None, 0.0
         
         try:
-            # White powder detection
-            white_mask = (img_array[:, :, 0] > 200) & (img_array[:, :, 1] > 200) & (img_array[:, :, 2] > 200)
-            white_ratio = np.sum(white_mask) / img_array.size
+            workspace = self.workspace(img_array)
             
-            # Texture analysis for powdery surface
-            gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
+            # White powder detection
+            white_ratio = features['white_ratio'] if features else workspace.color_ratio('white')
             
             # Powdery mildew has specific texture
-            edges = cv2.Canny(gray, 50, 150)
-            edge_density = np.sum(edges > 0) / edges.size
+            edges = cv2.Canny(workspace.grayscale(), 50, 150, edges=workspace.edges)
+            edge_density = np.count_nonzero(edges) / edges.size
             
             if white_ratio > 0.15 and edge_density < 0.1:
                 return 'Powdery Mildew', 0.85
@@ -334,87 +692,47 @@ class FixedUltraPlantAnalyzer:
             logger.error(f"Enhanced Gemini analysis failed: {e}")
             return None
     
-    def ultra_accurate_analysis(self, image_bytes, moisture=None, temp=None, humidity=None):
-        """Main analysis with Gemini as primary and manual algorithms as backup"""
-        processed_images, original = self.advanced_preprocessing(image_bytes)
-        img_array = np.array(processed_images['enhanced'])
-        
-        # 1. Try Gemini analysis FIRST (Highly Accurate with Sensor Context)
-        try:
-            gemini_result = self.analyze_with_gemini_enhanced(image_bytes, moisture, temp, humidity)
-            if gemini_result and gemini_result.get('confidence', 0) > 0.6:
-                logger.info(f"✓ Gemini Analysis Success: {gemini_result.get('disease_name')}")
-                return {
-                    'success': True,
-                    'disease': f"{gemini_result.get('plant_species', 'Unknown')} - {gemini_result.get('disease_name', 'Unknown')}",
-                    'confidence': round(gemini_result.get('confidence', 0.8) * 100, 2),
-                    'is_healthy': 'healthy' in gemini_result.get('disease_name', '').lower(),
-                    'plant_type': gemini_result.get('plant_species', 'Unknown'),
-                    'treatment': gemini_result.get('treatment', 'Monitor plant health'),
-                    'prevention': gemini_result.get('prevention', 'Good agricultural practices'),
-                    'severity': gemini_result.get('severity', 'Unknown'),
-                    'model_version': 'Enhanced Gemini AI v1.5',
-                    'detection_method': 'Google Gemini Vision',
-                    'timestamp': datetime.now().isoformat()
-                }
-        except Exception as e:
-            logger.error(f"Gemini AI Error (Possible 404 or Rate Limit): {e}")
-
-        # 2. Fallback to specialized manual detection (Backup)
-        logger.info("Falling back to specialized manual algorithms...")
-        
-        # Try specialized tomato mold detection
-        disease, confidence = self.detect_tomato_leaf_mold(img_array)
-        if disease and confidence > 0.7:
-            return {
-                'success': True,
-                'disease': disease,
-                'confidence': round(confidence * 100, 2),
-                'is_healthy': False,
-                'plant_type': 'Tomato',
-                'treatment': 'Increase ventilation, reduce humidity, apply copper-based fungicide',
-                'prevention': 'Ensure good air circulation, water at base of plants',
-                'severity': 'Moderate to Severe',
-                'model_version': 'Manual Backup v2.0',
-                'detection_method': 'Specialized CV Algorithm',
-                'timestamp': datetime.now().isoformat()
-            }
-        
-        # Try early blight detection
-        disease, confidence = self.detect_early_blight(img_array)
-        if disease and confidence > 0.7:
-            return {
-                'success': True,
-                'disease': disease,
-                'confidence': round(confidence * 100, 2),
-                'is_healthy': False,
-                'plant_type': 'Tomato',
-                'treatment': 'Remove affected leaves, apply fungicide',
-                'prevention': 'Crop rotation, proper spacing',
-                'severity': 'Moderate',
-                'model_version': 'Manual Backup v2.0',
-                'detection_method': 'Specialized CV Algorithm',
-                'timestamp': datetime.now().isoformat()
-            }
+    def format_gemini_result(self, gemini_result):
+        """Map a confident Gemini answer to the API result shape, or None"""
+        if not gemini_result or gemini_result.get('confidence', 0) <= 0.6:
+            return None
         
-        # Try powdery mildew detection
-        disease, confidence = self.detect_powdery_mildew(img_array)
-        if disease and confidence > 0.7:
+        logger.info(f"✓ Gemini Analysis Success: {gemini_result.get('disease_name')}")
+        return {
+            'success': True,
+            'disease': f"{gemini_result.get('plant_species', 'Unknown')} - {gemini_result.get('disease_name', 'Unknown')}",
+            'confidence': round(gemini_result.get('confidence', 0.8) * 100, 2),
+            'is_healthy': 'healthy' in gemini_result.get('disease_name', '').lower(),
+            'plant_type': gemini_result.get('plant_species', 'Unknown'),
+            'treatment': gemini_result.get('treatment', 'Monitor plant health'),
+            'prevention': gemini_result.get('prevention', 'Good agricultural practices'),
+            'severity': gemini_result.get('severity', 'Unknown'),
+            'model_version': 'Enhanced Gemini AI v1.5',
+            'detection_method': 'Google Gemini Vision',
+            'timestamp': datetime.now().isoformat()
+        }
+    
+    def local_analysis(self, img_array):
+        """Specialized CV detectors, then general color analysis"""
+        # Run specialized detectors cheapest-per-hit first, skipping those that cannot fire
+        name, disease, confidence = self.cascade.run(self, img_array)
+        if name:
+            detector = FALLBACK_DETECTORS[name]
             return {
                 'success': True,
                 'disease': disease,
                 'confidence': round(confidence * 100, 2),
                 'is_healthy': False,
-                'plant_type': 'Unknown',
-                'treatment': 'Apply sulfur fungicide, improve ventilation',
-                'prevention': 'Proper spacing, resistant varieties',
-                'severity': 'Moderate',
+                'plant_type': detector['plant_type'],
+                'treatment': detector['treatment'],
+                'prevention': detector['prevention'],
+                'severity': detector['severity'],
                 'model_version': 'Manual Backup v2.0',
                 'detection_method': 'Specialized CV Algorithm',
                 'timestamp': datetime.now().isoformat()
             }
         
-        # 3. Final Fallback to general color analysis
+        # Final Fallback to general color analysis
         disease, confidence = self.general_plant_analysis(img_array)
         return {
             'success': True,
@@ -429,22 +747,50 @@ class FixedUltraPlantAnalyzer:
             'detection_method': 'Color Analysis',
             'timestamp': datetime.now().isoformat()
         }
+    
+    def ultra_accurate_analysis(self, image_bytes, moisture=None, temp=None, humidity=None):
+        """Main analysis with Gemini as primary and manual algorithms as backup"""
+        img_array = self.advanced_preprocessing(image_bytes)
         
-        # Fallback to general analysis
-        disease, confidence = self.general_plant_analysis(img_array)
-        return {
-            'success': True,
-            'disease': disease,
-            'confidence': round(confidence * 100, 2),
-            'is_healthy': 'healthy' in disease.lower(),
-            'plant_type': 'Unknown',
-            'treatment': 'Monitor plant health and provide proper care',
-            'prevention': 'Maintain good growing conditions',
-            'severity': 'Unknown',
-            'model_version': 'General Analysis',
-            'detection_method': 'Color Analysis',
-            'timestamp': datetime.now().isoformat()
-        }
+        # 1. Try Gemini analysis FIRST (Highly Accurate with Sensor Context)
+        try:
+            result = self.format_gemini_result(self.analyze_with_gemini_enhanced(image_bytes, moisture, temp, humidity))
+            if result:
+                return result
+        except Exception as e:
+            logger.error(f"Gemini AI Error (Possible 404 or Rate Limit): {e}")
+
+        # 2. Fallback to specialized manual detection (Backup)
+        logger.info("Falling back to specialized manual algorithms...")
+        return self.local_analysis(img_array)
+    
+    def analysis_events(self, image_bytes, moisture=None, temp=None, humidity=None, gemini_call=None):
+        """
+        Progressive variant of ultra_accurate_analysis yielding (event, payload) pairs:
+        the fast local CV verdict first, then the Gemini refinement and the final result.
+        """
+        start = time.perf_counter()
+        
+        def elapsed_ms():
+            return round((time.perf_counter() - start) * 1000, 1)
+        
+        yield 'received', {'bytes': len(image_bytes)}
+        
+        img_array = self.advanced_preprocessing(image_bytes)
+        yield 'preprocessed', {'elapsed_ms': elapsed_ms()}
+        
+        local_result = self.local_analysis(img_array)
+        yield 'local_result', {'elapsed_ms': elapsed_ms(), 'result': local_result}
+        
+        gemini_call = gemini_call or self.analyze_with_gemini_enhanced
+        try:
+            gemini_result = self.format_gemini_result(gemini_call(image_bytes, moisture, temp, humidity))
+        except Exception as e:
+            logger.error(f"Gemini AI Error (Possible 404 or Rate Limit): {e}")
+            gemini_result = None
+        yield 'gemini_result', {'elapsed_ms': elapsed_ms(), 'result': gemini_result}
+        
+        yield 'final', {'elapsed_ms': elapsed_ms(), 'result': gemini_result or local_result}
 
 # Initialize analyzer
 fixed_analyzer = FixedUltraPlantAnalyzer()
@@ -526,6 +872,331 @@ def enhance_with_sensors(ai_result, moisture, temp, humidity):
     logger.info(f"Added {len(recommendations)} sensor-based recommendations")
     return ai_result
 
+class TokenBucket:
+    """Classic token bucket refilled continuously at `rate` tokens per second"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+    
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def take(self, now):
+        """Consume one token; returns 0 on success or seconds until one is available"""
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        if self.rate <= 0:
+            return 60.0
+        return (1 - self.tokens) / self.rate
+
+class DeviceAdmissionController:
+    """Per-device rate limiting plus a round-robin fair-share queue for /predict"""
+    MAX_TRACKED_DEVICES = 1024
+    
+    def __init__(self, rate_per_minute, burst, max_concurrent, max_queued_per_device, queue_timeout):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queued_per_device = max_queued_per_device
+        self.queue_timeout = queue_timeout
+        self.buckets = {}
+        self.stats = {}
+        self.queues = OrderedDict()  # device -> deque of waiting tickets, in round-robin order
+        self.active = 0
+        self.cond = threading.Condition()
+    
+    def _device_stats(self, device):
+        if device not in self.stats:
+            self.stats[device] = {
+                'admitted': 0,
+                'rejected_rate_limit': 0,
+                'rejected_queue_full': 0,
+                'rejected_queue_timeout': 0,
+                'in_flight': 0,
+                'queued': 0,
+                'last_seen': None
+            }
+        return self.stats[device]
+    
+    def _prune(self, now):
+        """Forget idle devices whose bucket has refilled, to bound memory"""
+        if len(self.buckets) <= self.MAX_TRACKED_DEVICES:
+            return
+        for device, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            stats = self.stats.get(device, {})
+            if bucket.tokens >= bucket.capacity and not stats.get('in_flight') and not stats.get('queued'):
+                del self.buckets[device]
+                self.stats.pop(device, None)
+    
+    def _dispatch(self):
+        """Grant free slots to queued tickets, one device at a time in rotation"""
+        granted = False
+        while self.active < self.max_concurrent and self.queues:
+            device, waiting = next(iter(self.queues.items()))
+            ticket = waiting.popleft()
+            if waiting:
+                self.queues.move_to_end(device)
+            else:
+                del self.queues[device]
+            ticket['granted'] = True
+            self.active += 1
+            stats = self._device_stats(device)
+            stats['queued'] -= 1
+            stats['in_flight'] += 1
+            granted = True
+        if granted:
+            self.cond.notify_all()
+    
+    def acquire(self, device):
+        """
+        Admit a request from `device`. Returns (admitted, retry_after_seconds, reason);
+        callers that were admitted must call release() when done.
+        """
+        with self.cond:
+            now = time.monotonic()
+            self._prune(now)
+            stats = self._device_stats(device)
+            stats['last_seen'] = datetime.now().isoformat()
+            
+            if self.max_queued_per_device >= 0 and len(self.queues.get(device, ())) >= self.max_queued_per_device \
+                    and self.active >= self.max_concurrent:
+                stats['rejected_queue_full'] += 1
+                return False, max(1, math.ceil(self.queue_timeout / 4)), 'Too many queued requests for this device'
+            
+            bucket = self.buckets.get(device)
+            if bucket is None:
+                bucket = self.buckets[device] = TokenBucket(self.rate, self.burst)
+            wait = bucket.take(now)
+            if wait > 0:
+                stats['rejected_rate_limit'] += 1
+                return False, max(1, math.ceil(wait)), 'Device request budget exceeded'
+            
+            ticket = {'granted': False}
+            self.queues.setdefault(device, deque()).append(ticket)
+            stats['queued'] += 1
+            self._dispatch()
+            
+            if not self.cond.wait_for(lambda: ticket['granted'], timeout=self.queue_timeout):
+                waiting = self.queues.get(device)
+                if waiting is not None:
+                    waiting.remove(ticket)
+                    if not waiting:
+                        del self.queues[device]
+                stats['queued'] -= 1
+                stats['rejected_queue_timeout'] += 1
+                return False, max(1, math.ceil(self.queue_timeout / 4)), 'Server busy, request timed out in queue'
+            
+            stats['admitted'] += 1
+            return True, 0, None
+    
+    def release(self, device):
+        with self.cond:
+            self.active -= 1
+            self._device_stats(device)['in_flight'] -= 1
+            self._dispatch()
+    
+    def snapshot(self):
+        with self.cond:
+            return {
+                'active': self.active,
+                'queued': sum(len(waiting) for waiting in self.queues.values()),
+                'devices': {
+                    device_label(device): dict(stats, tokens=round(self.buckets[device].tokens, 2) if device in self.buckets else None)
+                    for device, stats in self.stats.items()
+                }
+            }
+
+def get_device_id(req):
+    """Identify the calling wand: X-Device-Id header, then bearer token, then client IP"""
+    device_id = req.headers.get('X-Device-Id', '').strip()
+    if device_id:
+        return device_id[:64]
+    
+    auth = req.headers.get('Authorization', '')
+    if auth.lower().startswith('bearer ') and auth[7:].strip():
+        # Never expose raw tokens in counters
+        return 'token:' + hashlib.sha256(auth[7:].strip().encode('utf-8')).hexdigest()[:12]
+    
+    # remote_addr already reflects the trusted proxy's hop (ProxyFix); the leading
+    # X-Forwarded-For entries are client-controlled and must not pick the bucket
+    return f"ip:{req.remote_addr or 'unknown'}"
+
+def device_label(device_id):
+    """
+    Pseudonymous label for published counters: MAC addresses and client IPs are
+    hashed (match a wand with sha256(<X-Device-Id>)[:12]); bearer ids are already hashed
+    """
+    if device_id.startswith('token:'):
+        return device_id
+    kind, raw = ('ip', device_id[3:]) if device_id.startswith('ip:') else ('device', device_id)
+    return f"{kind}:{hashlib.sha256(raw.encode('utf-8')).hexdigest()[:12]}"
+
+admission = DeviceAdmissionController(
+    DEVICE_RATE_PER_MINUTE, DEVICE_BURST, PREDICT_CONCURRENCY, DEVICE_MAX_QUEUED, PREDICT_QUEUE_TIMEOUT
+)
+
+# Take the client IP from the hops our own proxies appended, not from what the client sent
+if TRUSTED_PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
+class RequestCoalescer:
+    """
+    Single-flight execution: concurrent calls with the same key share one result.
+    Within a worker, followers wait on the leader's event. When `lock_dir` is set,
+    workers also serialize on a per-key file lock and pick up each other's
+    results from short-lived JSON files.
+    """
+    SWEEP_EVERY = 100
+    STALE_FILE_AGE = 3600
+    
+    def __init__(self, lock_dir='', result_ttl=15):
+        self.lock_dir = lock_dir if lock_dir and FCNTL_AVAILABLE else ''
+        self.result_ttl = result_ttl
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.stats = {'leaders': 0, 'followers': 0, 'shared_across_workers': 0}
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+    
+    def run(self, key, fn):
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = {'event': threading.Event(), 'result': None, 'error': None}
+                self.stats['leaders'] += 1
+                leader = True
+            else:
+                self.stats['followers'] += 1
+                leader = False
+        
+        if not leader:
+            flight['event'].wait()
+            if flight['error'] is not None:
+                raise flight['error']
+            return copy.deepcopy(flight['result'])
+        
+        try:
+            flight['result'] = self._run_shared(key, fn) if self.lock_dir else fn()
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight['event'].set()
+        
+        return copy.deepcopy(flight['result'])
+    
+    def _run_shared(self, key, fn):
+        """Cross-worker single flight: whoever holds the key's flock computes"""
+        lock_path = os.path.join(self.lock_dir, f'{key}.lock')
+        result_path = os.path.join(self.lock_dir, f'{key}.json')
+        
+        lock_file = self._acquire(lock_path)
+        try:
+            os.utime(lock_file.fileno())  # keeps the sweep away from keys still in use
+            hit, cached = self._read_result(result_path)
+            if hit:
+                with self.lock:
+                    self.stats['shared_across_workers'] += 1
+                return cached
+            
+            result = fn()
+            tmp_path = f'{result_path}.{os.getpid()}.{threading.get_ident()}'
+            with open(tmp_path, 'w') as f:
+                json.dump({'result': result}, f)  # wrapped so a None result is shared too
+            os.replace(tmp_path, result_path)
+            return result
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+            if self.stats['leaders'] % self.SWEEP_EVERY == 0:
+                self._sweep()
+    
+    @staticmethod
+    def _holds_current_inode(lock_file, lock_path):
+        try:
+            return os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino
+        except FileNotFoundError:
+            return False
+    
+    def _acquire(self, lock_path):
+        """Flock the key's lock file, retrying if the sweep unlinked it while we waited"""
+        while True:
+            lock_file = open(lock_path, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if self._holds_current_inode(lock_file, lock_path):
+                return lock_file
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+    
+    def _sweep(self):
+        """
+        Remove files for keys not seen in a long while. A lock file is only
+        unlinked while we hold its flock; a worker already waiting on the old
+        inode notices the path moved on and retries on a fresh one.
+        """
+        cutoff = time.time() - max(self.STALE_FILE_AGE, self.result_ttl)
+        for name in os.listdir(self.lock_dir):
+            path = os.path.join(self.lock_dir, name)
+            try:
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+                if not name.endswith('.lock'):  # results and orphaned temp files
+                    os.remove(path)
+                    continue
+                with open(path) as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue  # in use right now
+                    try:
+                        if self._holds_current_inode(lock_file, path) and os.path.getmtime(path) < cutoff:
+                            os.remove(path)
+                    finally:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+            except OSError:
+                pass
+    
+    def _read_result(self, result_path):
+        """Return (hit, result) for a fresh result file"""
+        try:
+            if time.time() - os.path.getmtime(result_path) > self.result_ttl:
+                return False, None
+            with open(result_path) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return False, None
+        if not isinstance(stored, dict) or 'result' not in stored:
+            return False, None
+        return True, stored['result']
+    
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, in_flight=len(self.flights), cross_worker=bool(self.lock_dir))
+
+def coalesce_key(image_bytes, moisture, temp, humidity):
+    """Key identical analyses by image hash and bucketed sensor readings"""
+    bucket = COALESCE_SENSOR_BUCKET if COALESCE_SENSOR_BUCKET > 0 else 1.0
+    sensors = '_'.join(str(int(round(value / bucket))) for value in (moisture, temp, humidity))
+    return f"{hashlib.sha256(image_bytes).hexdigest()}_{sensors}"
+
+def read_sensor_header(req, name):
+    """Sensor reading from a request header; nan/inf (a failed sensor read) counts as no reading"""
+    value = float(req.headers.get(name, 0))
+    if not math.isfinite(value):
+        logger.warning(f"Ignoring non-finite {name}: {req.headers.get(name)}")
+        return 0.0
+    return value
+
+coalescer = RequestCoalescer(COALESCE_DIR, COALESCE_RESULT_TTL)
+
 # Enhanced HTML Template
 HTML_TEMPLATE = """<!DOCTYPE html>
 <html lang="en">
@@ -571,6 +1242,8 @@ HTML_TEMPLATE = """<!DOCTYPE html>
         .treatment-section { background: #f8f9ff; padding: 20px; border-radius: 10px; margin-top: 15px; }
         .treatment-section h3 { color: #28a745; margin-bottom: 10px; }
         .detection-info { background: #d4edda; padding: 15px; border-radius: 10px; margin-top: 15px; border-left: 4px solid #28a745; }
+        .refining { display: none; background: #fff3cd; color: #856404; padding: 10px 15px; border-radius: 10px; margin-bottom: 15px; text-align: center; }
+        .refining.active { display: block; }
         .btn-clear { background: #6c757d; color: white; border: none; padding: 10px 25px; border-radius: 20px; cursor: pointer; margin-top: 15px; }
     </style>
 </head>
@@ -607,10 +1280,11 @@ HTML_TEMPLATE = """<!DOCTYPE html>
                 
                 <div class="loading" id="loading">
                     <div class="spinner"></div>
-                    <p>Running enhanced analysis...</p>
+                    <p id="loadingText">Running enhanced analysis...</p>
                 </div>
 
                 <div class="results" id="results">
+                    <div class="refining" id="refining">⏳ Quick local result - refining with Gemini AI...</div>
                     <div class="result-header" id="resultHeader">
                         <div class="disease-name" id="diseaseName">-</div>
                         <div class="confidence" id="confidence">-</div>
@@ -647,6 +1321,8 @@ HTML_TEMPLATE = """<!DOCTYPE html>
         const analyzeBtn = document.getElementById('analyzeBtn');
         const clearBtn = document.getElementById('clearBtn');
         const loading = document.getElementById('loading');
+        const loadingText = document.getElementById('loadingText');
+        const refining = document.getElementById('refining');
         const results = document.getElementById('results');
         const initialMessage = document.getElementById('initialMessage');
 
@@ -700,29 +1376,72 @@ HTML_TEMPLATE = """<!DOCTYPE html>
                 return;
             }
 
+            loadingText.textContent = 'Uploading image...';
             loading.classList.add('active');
             results.classList.remove('active');
+            refining.classList.remove('active');
             initialMessage.style.display = 'none';
             analyzeBtn.disabled = true;
 
             try {
-                const response = await fetch('/predict', {
+                // Stream stage events so the fast local verdict shows before Gemini answers
+                const response = await fetch('/predict?stream=ndjson', {
                     method: 'POST',
                     body: selectedFile
                 });
 
-                const data = await response.json();
-                loading.classList.remove('active');
-                displayFixedResults(data);
+                if (!response.ok || !response.body) {
+                    const data = await response.json();
+                    throw new Error(data.error || `HTTP ${response.status}`);
+                }
+
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                let finished = false;
+                while (true) {
+                    const { done, value } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    let newline;
+                    while ((newline = buffer.indexOf('\\n')) >= 0) {
+                        const line = buffer.slice(0, newline).trim();
+                        buffer = buffer.slice(newline + 1);
+                        if (line) finished = handleStageEvent(JSON.parse(line)) || finished;
+                    }
+                }
+                if (buffer.trim()) finished = handleStageEvent(JSON.parse(buffer)) || finished;
+                // A dropped connection ends the stream without a final event
+                if (!finished) throw new Error('Incomplete result - the analysis stream ended early');
 
             } catch (error) {
                 loading.classList.remove('active');
+                refining.classList.remove('active');
                 alert('Error: ' + error.message);
             } finally {
                 analyzeBtn.disabled = false;
             }
         });
 
+        function handleStageEvent(evt) {
+            if (evt.event === 'received') {
+                loadingText.textContent = 'Image received, preprocessing...';
+            } else if (evt.event === 'preprocessed') {
+                loadingText.textContent = 'Running local detectors...';
+            } else if (evt.event === 'local_result') {
+                loading.classList.remove('active');
+                displayFixedResults(evt.result);
+                refining.classList.add('active');
+            } else if (evt.event === 'final') {
+                loading.classList.remove('active');
+                refining.classList.remove('active');
+                displayFixedResults(evt.result);
+                return true;
+            } else if (evt.event === 'error') {
+                throw new Error(evt.error);
+            }
+        }
+
         function displayFixedResults(data) {
             const resultHeader = document.getElementById('resultHeader');
             const diseaseName = document.getElementById('diseaseName');
@@ -762,18 +1481,101 @@ HTML_TEMPLATE = """<!DOCTYPE html>
 </body>
 </html>"""
 
+def build_static_asset(body, mimetype):
+    """Precompute identity/gzip/brotli variants and ETags for a static body"""
+    raw = body.encode('utf-8')
+    digest = hashlib.sha256(raw).hexdigest()[:16]
+    variants = {'identity': raw, 'gzip': gzip.compress(raw, compresslevel=9, mtime=0)}
+    if BROTLI_AVAILABLE:
+        variants['br'] = brotli.compress(raw, quality=11)
+    
+    return {
+        'mimetype': mimetype,
+        'variants': variants,
+        'etags': {
+            encoding: f'"{digest}"' if encoding == 'identity' else f'"{digest}-{encoding}"'
+            for encoding in variants
+        }
+    }
+
+def serve_static_asset(asset, cache_control='no-cache'):
+    """Serve a precomputed asset with content negotiation and conditional GET"""
+    encoding = 'identity'
+    for candidate in ('br', 'gzip'):
+        if candidate in asset['variants'] and request.accept_encodings[candidate] > 0:
+            encoding = candidate
+            break
+    
+    etag = asset['etags'][encoding]
+    headers = {
+        'ETag': etag,
+        'Cache-Control': cache_control,
+        'Vary': 'Accept-Encoding'
+    }
+    
+    # Any variant ETag satisfies If-None-Match: the underlying content is the same
+    if any(request.if_none_match.contains_weak(tag.strip('"')) for tag in asset['etags'].values()):
+        return Response(status=304, headers=headers)
+    
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(asset['variants'][encoding], mimetype=asset['mimetype'], headers=headers)
+
+# Built once per worker at import time; the page has no per-request state
+INDEX_ASSET = build_static_asset(HTML_TEMPLATE, 'text/html')
+
 @app.route('/')
 def index():
-    hostname = socket.gethostname()
-    local_ip = socket.gethostbyname(hostname)
+    # The page URL is unversioned: always revalidate (cheap 304s) so deploys show up at once
+    return serve_static_asset(INDEX_ASSET, 'no-cache')
+
+def get_stream_format(req):
+    """'sse' or 'ndjson' when the client asked for progressive results, else None"""
+    requested = req.args.get('stream', '').lower()
+    if requested in ('sse', 'ndjson'):
+        return requested
+    accept = req.headers.get('Accept', '')
+    if 'text/event-stream' in accept:
+        return 'sse'
+    if 'application/x-ndjson' in accept:
+        return 'ndjson'
+    return None
+
+def format_stream_event(stream_format, event, payload):
+    data = json.dumps({'event': event, **payload})
+    if stream_format == 'sse':
+        return f"event: {event}\ndata: {data}\n\n"
+    return data + "\n"
+
+def stream_prediction(stream_format, image_bytes, soil_moisture, temperature, humidity):
+    """Yield stage events for one analysis"""
+    has_sensors = soil_moisture > 0 or temperature > 0 or humidity > 0
+    key = coalesce_key(image_bytes, soil_moisture, temperature, humidity)
+    # Duplicate streams still share a single Gemini call
+    gemini_call = lambda *args: coalescer.run(key + '_gemini', lambda: fixed_analyzer.analyze_with_gemini_enhanced(*args))
+    
+    try:
+        for event, payload in fixed_analyzer.analysis_events(image_bytes, soil_moisture, temperature, humidity, gemini_call):
+            if payload.get('result') and has_sensors and event in ('local_result', 'final'):
+                payload['result'] = enhance_with_sensors(copy.deepcopy(payload['result']), soil_moisture, temperature, humidity)
+            yield format_stream_event(stream_format, event, payload)
     
-    return render_template_string(
-        HTML_TEMPLATE,
-        server_url=f"http://{local_ip}:5000"
-    )
+    except Exception as e:
+        logger.error(f"Streaming prediction error: {str(e)}")
+        yield format_stream_event(stream_format, 'error', {'success': False, 'error': str(e)})
 
 @app.route('/predict', methods=['POST'])
 def predict():
+    device_id = get_device_id(request)
+    admitted, retry_after, reason = admission.acquire(device_id)
+    if not admitted:
+        logger.warning(f"Rejected request from {device_id}: {reason}")
+        response = jsonify({'success': False, 'error': reason, 'device_id': device_id, 'retry_after': retry_after})
+        response.headers['Retry-After'] = str(retry_after)
+        return response, 429
+    
+    # Streaming responses release the admission slot when the stream ends
+    release_slot = True
     try:
         # Get image data
         if request.files and 'file' in request.files:
@@ -785,9 +1587,9 @@ def predict():
             return jsonify({'success': False, 'error': 'No image data'}), 400
         
         # Get sensor data from custom headers
-        soil_moisture = float(request.headers.get('X-Soil-Moisture', 0))
-        temperature = float(request.headers.get('X-Temperature', 0))
-        humidity = float(request.headers.get('X-Humidity', 0))
+        soil_moisture = read_sensor_header(request, 'X-Soil-Moisture')
+        temperature = read_sensor_header(request, 'X-Temperature')
+        humidity = read_sensor_header(request, 'X-Humidity')
         
         logger.info(f"Analysis request: {len(image_bytes)} bytes")
         if soil_moisture > 0 or temperature > 0 or humidity > 0:
@@ -799,8 +1601,24 @@ def predict():
         with open(save_path, 'wb') as f:
             f.write(image_bytes)
         
+        stream_format = get_stream_format(request)
+        if stream_format:
+            response = Response(
+                stream_prediction(stream_format, image_bytes, soil_moisture, temperature, humidity),
+                mimetype='text/event-stream' if stream_format == 'sse' else 'application/x-ndjson',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+            # Runs when the server closes the response, even if the client hung up early
+            response.call_on_close(lambda: admission.release(device_id))
+            release_slot = False
+            return response
+        
         # Perform AI analysis with live sensor context
-        result = fixed_predict_plant(image_bytes, soil_moisture, temperature, humidity)
+        # Duplicate submissions (double-clicks, device retries) share one analysis
+        result = coalescer.run(
+            coalesce_key(image_bytes, soil_moisture, temperature, humidity),
+            lambda: fixed_predict_plant(image_bytes, soil_moisture, temperature, humidity)
+        )
         
         # Further refine with sensor-based expert rules
         if soil_moisture > 0 or temperature > 0 or humidity > 0:
@@ -812,6 +1630,10 @@ def predict():
     except Exception as e:
         logger.error(f"Prediction error: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
+    
+    finally:
+        if release_slot:
+            admission.release(device_id)
 
 @app.route('/health', methods=['GET'])
 def health():
@@ -824,9 +1646,26 @@ def health():
         'sdk': 'google-genai (2026 Edition)',
         'special_features': ['Enhanced Tomato Mold Detection', 'Early Blight Detection', 'Powdery Mildew Detection'],
         'plant_support': 'Global - All vegetables + Lebanese herbs',
-        'accuracy_target': '90%+ for tomato diseases'
+        'accuracy_target': '90%+ for tomato diseases',
+        'coalescing': coalescer.snapshot(),
+        'cascade': fixed_analyzer.cascade.snapshot()
     }), 200
 
+@app.route('/devices', methods=['GET'])
+def devices():
+    """Per-device admission counters for this worker process, keyed by hashed device labels"""
+    return jsonify(dict(
+        admission.snapshot(),
+        worker_pid=os.getpid(),
+        limits={
+            'rate_per_minute': DEVICE_RATE_PER_MINUTE,
+            'burst': DEVICE_BURST,
+            'max_queued_per_device': DEVICE_MAX_QUEUED,
+            'concurrency': PREDICT_CONCURRENCY,
+            'queue_timeout': PREDICT_QUEUE_TIMEOUT
+        }
+    )), 200
+
 if __name__ == '__main__':
     logger.info("Starting Fixed Ultra-Accurate Agricultural AI Wand Server")
     logger.info(f"Gemini SDK (google-genai) Available: {fixed_analyzer.gemini_available}")
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Offline replay and regression harness for the Agri-Wand analysis pipeline
+Streams archived uploads through ultra_accurate_analysis and reports throughput,
+per-stage latency percentiles and disease diffs between two runs.
+
+Examples:
+    python replay_uploads.py run uploads --output current.jsonl
+    python replay_uploads.py run manifest.csv --gemini replay --gemini-store gemini.json
+    python replay_uploads.py run uploads --server old/fixed_ultra_server.py --output baseline.jsonl
+    python replay_uploads.py diff baseline.jsonl current.jsonl
+"""
+
+import argparse
+import csv
+import hashlib
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+# Analyzer methods timed as pipeline stages when present on the loaded version
+STAGES = [
+    'advanced_preprocessing',
+    'analyze_with_gemini_enhanced',
+    'extract_shared_features',
+    'detect_tomato_leaf_mold',
+    'detect_early_blight',
+    'detect_powdery_mildew',
+    'general_plant_analysis'
+]
+
+def load_server(path):
+    """Import a specific version of the server module from a file path"""
+    spec = importlib.util.spec_from_file_location(f'replay_server_{abs(hash(path))}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def parse_sensor(value):
+    if value is None or str(value).strip() == '':
+        return 0.0
+    return float(value)
+
+def iter_samples(source):
+    """
+    Yield samples lazily from an uploads directory or a CSV/JSONL manifest.
+    Manifest rows need a `path` (relative to the manifest) and may carry
+    `moisture`, `temp` and `humidity`.
+    """
+    if os.path.isdir(source):
+        for entry in sorted(os.scandir(source), key=lambda e: e.name):
+            if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                yield {'path': entry.path, 'moisture': 0.0, 'temp': 0.0, 'humidity': 0.0}
+        return
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source, newline='') as f:
+        if source.endswith('.csv'):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            path = row['path'] if os.path.isabs(row['path']) else os.path.join(base_dir, row['path'])
+            yield {
+                'path': path,
+                'moisture': parse_sensor(row.get('moisture')),
+                'temp': parse_sensor(row.get('temp')),
+                'humidity': parse_sensor(row.get('humidity'))
+            }
+
+def sample_key(image_bytes, moisture, temp, humidity):
+    return f"{hashlib.sha256(image_bytes).hexdigest()}_{moisture:.1f}_{temp:.1f}_{humidity:.1f}"
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[index]
+
+class GeminiBackend:
+    """
+    Controls the Gemini stage during replay:
+    off    - never call Gemini (exercises the local CV fallback path)
+    live   - call the real API
+    record - call the real API and store responses in the store file
+    replay - answer from the store file only, never touching the network
+    """
+    def __init__(self, mode, store_path=None):
+        if mode in ('record', 'replay') and not store_path:
+            raise ValueError(f"--gemini {mode} requires --gemini-store")
+        self.mode = mode
+        self.store_path = store_path
+        self.lock = threading.Lock()
+        self.store = {}
+        self.misses = 0
+        if store_path and os.path.exists(store_path):
+            with open(store_path) as f:
+                self.store = json.load(f)
+
+    def install(self, analyzer):
+        live_call = analyzer.analyze_with_gemini_enhanced
+
+        def analyze(image_bytes, moisture=None, temp=None, humidity=None):
+            if self.mode == 'off':
+                return None
+            if self.mode == 'live':
+                return live_call(image_bytes, moisture, temp, humidity)
+
+            key = sample_key(image_bytes, moisture or 0.0, temp or 0.0, humidity or 0.0)
+            if self.mode == 'replay':
+                with self.lock:
+                    if key not in self.store:
+                        self.misses += 1
+                    return self.store.get(key)
+
+            result = live_call(image_bytes, moisture, temp, humidity)
+            with self.lock:
+                self.store[key] = result
+            return result
+
+        analyzer.analyze_with_gemini_enhanced = analyze
+
+    def save(self):
+        if self.mode == 'record':
+            with open(self.store_path, 'w') as f:
+                json.dump(self.store, f, indent=1)
+
+class StageTimer:
+    """Wraps analyzer methods so each call's latency lands on the current sample"""
+    def __init__(self):
+        self.local = threading.local()
+
+    def install(self, analyzer):
+        for stage in STAGES:
+            method = getattr(analyzer, stage, None)
+            if method is not None:
+                setattr(analyzer, stage, self._wrap(stage, method))
+
+    def _wrap(self, stage, method):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                timings = getattr(self.local, 'timings', None)
+                if timings is not None:
+                    timings[stage] = timings.get(stage, 0.0) + (time.perf_counter() - start) * 1000
+        return timed
+
+    def begin(self):
+        self.local.timings = {}
+
+    def end(self):
+        timings, self.local.timings = self.local.timings, None
+        return timings
+
+def replay_one(analyzer, timer, sample):
+    record = {'path': sample['path'], 'key': None, 'bytes': 0}
+    timer.begin()
+    start = time.perf_counter()
+    try:
+        with open(sample['path'], 'rb') as f:
+            image_bytes = f.read()
+        record.update({
+            'key': sample_key(image_bytes, sample['moisture'], sample['temp'], sample['humidity']),
+            'bytes': len(image_bytes)
+        })
+        result = analyzer.ultra_accurate_analysis(image_bytes, sample['moisture'], sample['temp'], sample['humidity'])
+        record.update({
+            'disease': result.get('disease'),
+            'confidence': result.get('confidence'),
+            'detection_method': result.get('detection_method')
+        })
+    except Exception as e:
+        record['error'] = str(e)
+    record['total_ms'] = (time.perf_counter() - start) * 1000
+    record['stages_ms'] = timer.end()
+    return record
+
+def run_replay(args):
+    server = load_server(args.server)
+    if not args.verbose:
+        server.logger.setLevel(logging.WARNING)
+    analyzer = server.fixed_analyzer
+    backend = GeminiBackend(args.gemini, args.gemini_store)
+    backend.install(analyzer)
+    timer = StageTimer()
+    timer.install(analyzer)
+
+    records = []
+    output = open(args.output, 'w') if args.output else None
+    samples = iter_samples(args.source)
+    if args.limit:
+        samples = itertools.islice(samples, args.limit)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        pending = set()
+
+        def drain(block):
+            done, rest = wait(pending, return_when=FIRST_COMPLETED) if block else (set(pending), set())
+            for future in done:
+                record = future.result()
+                records.append(record)
+                if output:
+                    output.write(json.dumps(record) + '\n')
+            return rest
+
+        # Keep a bounded window in flight so huge directories stream instead of queueing up front
+        for sample in samples:
+            pending.add(pool.submit(replay_one, analyzer, timer, sample))
+            if len(pending) >= args.workers * 2:
+                pending = drain(block=True)
+        wait(pending)
+        drain(block=False)
+    wall = time.perf_counter() - start
+
+    if output:
+        output.close()
+    backend.save()
+
+    report = build_report(records, wall)
+    report['gemini'] = {'mode': backend.mode, 'replay_misses': backend.misses}
+    if args.compare:
+        report['diff'] = diff_records(read_records(args.compare), records)
+    return report
+
+def build_report(records, wall):
+    stage_values = {}
+    for record in records:
+        for stage, ms in (record.get('stages_ms') or {}).items():
+            stage_values.setdefault(stage, []).append(ms)
+    stage_values['total'] = [record['total_ms'] for record in records]
+
+    diseases = {}
+    for record in records:
+        label = record.get('disease') or 'ERROR'
+        diseases[label] = diseases.get(label, 0) + 1
+
+    return {
+        'images': len(records),
+        'errors': sum(1 for record in records if 'error' in record),
+        'wall_seconds': round(wall, 3),
+        'throughput_per_second': round(len(records) / wall, 2) if wall > 0 else 0.0,
+        'stages_ms': {
+            stage: {
+                'calls': len(values),
+                'p50': round(percentile(values, 50), 2),
+                'p90': round(percentile(values, 90), 2),
+                'p99': round(percentile(values, 99), 2),
+                'max': round(max(values), 2) if values else 0.0
+            }
+            for stage, values in stage_values.items()
+        },
+        'diseases': dict(sorted(diseases.items(), key=lambda item: -item[1]))
+    }
+
+def read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def diff_records(baseline, current):
+    """Compare detected disease per sample key between two result files"""
+    # unreadable samples have no key and cannot be compared
+    before = {record['key']: record for record in baseline if record.get('key')}
+    after = {record['key']: record for record in current if record.get('key')}
+    changed = []
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key], after[key]
+        if old.get('disease') != new.get('disease'):
+            changed.append({
+                'path': new['path'],
+                'before': old.get('disease'),
+                'after': new.get('disease'),
+                'confidence_before': old.get('confidence'),
+                'confidence_after': new.get('confidence')
+            })
+    return {
+        'compared': len(before.keys() & after.keys()),
+        'only_in_baseline': len(before.keys() - after.keys()),
+        'only_in_current': len(after.keys() - before.keys()),
+        'changed': changed
+    }
+
+def print_report(report):
+    print(f"Images: {report['images']}  Errors: {report['errors']}  "
+          f"Wall: {report['wall_seconds']}s  Throughput: {report['throughput_per_second']} img/s")
+    print(f"Gemini backend: {report['gemini']['mode']} (replay misses: {report['gemini']['replay_misses']})")
+    print(f"\n{'stage':<32}{'calls':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, stats in report['stages_ms'].items():
+        print(f"{stage:<32}{stats['calls']:>7}{stats['p50']:>10}{stats['p90']:>10}{stats['p99']:>10}{stats['max']:>10}")
+    print("\nDetected diseases:")
+    for disease, count in report['diseases'].items():
+        print(f"  {count:>5}  {disease}")
+    if 'diff' in report:
+        print_diff(report['diff'])
+
+def print_diff(diff):
+    print(f"\nCompared {diff['compared']} samples "
+          f"({diff['only_in_baseline']} only in baseline, {diff['only_in_current']} only in current)")
+    print(f"Changed verdicts: {len(diff['changed'])}")
+    for change in diff['changed']:
+        print(f"  {os.path.basename(change['path'])}: {change['before']} -> {change['after']}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay archived uploads through the analysis pipeline')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Replay an uploads directory or manifest')
+    run_parser.add_argument('source', help='Uploads directory, or a .csv/.jsonl manifest with path,moisture,temp,humidity')
+    run_parser.add_argument('--server', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixed_ultra_server.py'),
+                            help='Server module file to replay against (e.g. an older version exported with git show)')
+    run_parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    run_parser.add_argument('--limit', type=int, default=0, help='Stop after this many samples')
+    run_parser.add_argument('--gemini', choices=['off', 'live', 'record', 'replay'], default='off')
+    run_parser.add_argument('--gemini-store', help='JSON file of recorded Gemini responses')
+    run_parser.add_argument('--output', help='Write per-sample results as JSONL')
+    run_parser.add_argument('--compare', help='Baseline JSONL to diff detected diseases against')
+    run_parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    run_parser.add_argument('--verbose', action='store_true', help='Keep the server\'s per-request INFO logging')
+
+    diff_parser = subparsers.add_parser('diff', help='Diff detected diseases between two result files')
+    diff_parser.add_argument('baseline')
+    diff_parser.add_argument('current')
+    diff_parser.add_argument('--json', action='store_true', help='Print the diff as JSON')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.command == 'diff':
+        diff = diff_records(read_records(args.baseline), read_records(args.current))
+        if args.json:
+            print(json.dumps(diff, indent=2))
+        else:
+            print_diff(diff)
+        return 1 if diff['changed'] else 0
+
+    try:
+        report = run_replay(args)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    # A regression run fails when any verdict changed against the baseline
+    return 1 if report.get('diff', {}).get('changed') else 0
+
+if __name__ == '__main__':
+    sys.exit(main())